@@ -1,16 +1,62 @@
 from pathlib import Path
 from enum import Enum
-from collections import deque
 from urllib.parse import urlparse
+import functools
 import subprocess
 import threading
+import queue
 import logging
+import os
+import numpy as np
+import cupyx
 import cv2
 
 
 LOGGER = logging.getLogger(__name__)
 WITH_GSTREAMER = True
 
+# OpenCV accepts 4-channel BGRx from a GStreamer appsink only from 4.5 onward
+WITH_BGRX_APPSINK = tuple(int(v) for v in cv2.__version__.split('.')[:2]) >= (4, 5)
+
+# cap OpenCV's thread pool so per-frame conversions in the capture thread
+# don't fan out across the cores used by inference and optical flow
+try:
+    cv2.setNumThreads(max(1, len(os.sched_getaffinity(0)) - 1))
+except AttributeError:
+    pass
+
+
+def _empty_frame(shape):
+    """Allocates a page-locked frame buffer so the downstream H2D copy
+    can be an async DMA transfer, falling back to pageable memory
+    when no CUDA device is available.
+    """
+    try:
+        return cupyx.empty_pinned(shape, dtype=np.uint8)
+    except RuntimeError:
+        return np.empty(shape, dtype=np.uint8)
+
+
+def _pin_io_thread():
+    """Pins the calling thread to one core to keep it off the compute cores."""
+    try:
+        cpus = os.sched_getaffinity(0)
+    except AttributeError:
+        return
+    if len(cpus) > 1:
+        os.sched_setaffinity(0, {max(cpus)})
+
+
+@functools.lru_cache(maxsize=None)
+def _gst_has_element(name):
+    """Checks whether a GStreamer element is installed, probing each name once.
+
+    Probing a single element parses a few KB instead of dumping the
+    entire multi-MB plugin catalog.
+    """
+    return subprocess.call(['gst-inspect-1.0', '--exists', name],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
 
 class Protocol(Enum):
     IMAGE = 0
@@ -21,6 +67,16 @@ class Protocol(Enum):
     HTTP  = 5
 
 
+_SCHEME_MAP = {
+    'csi': Protocol.CSI,
+    'rtsp': Protocol.RTSP,
+    'http': Protocol.HTTP,
+}
+
+# codecs nvv4l2decoder can handle, notably excluding (M)JPEG
+_NVDEC_CODECS = frozenset({'h264', 'h265', 'vp8', 'vp9'})
+
+
 class VideoIO:
     def __init__(self, size, input_uri,
                  output_uri=None,
@@ -70,41 +126,85 @@ class VideoIO:
         self.protocol = self._parse_uri(self.input_uri)
         self.is_live = self.protocol != Protocol.IMAGE and self.protocol != Protocol.VIDEO
         if WITH_GSTREAMER:
-            line = self._gst_cap_pipeline()
-            print("Capture pipeline " + line)
-            self.source = cv2.VideoCapture(line, cv2.CAP_GSTREAMER)
+            self.cap_pipeline = self._gst_cap_pipeline()
+            LOGGER.debug('Capture pipeline: %s', self.cap_pipeline)
+            self.source = cv2.VideoCapture(self.cap_pipeline, cv2.CAP_GSTREAMER)
         else:
+            self.cap_pipeline = None
             self.source = cv2.VideoCapture(self.input_uri)
 
-        self.frame_queue = deque([], maxlen=self.buffer_size)
-        self.cond = threading.Condition()
+        self._lock = threading.Lock()
         self.exit_event = threading.Event()
-        self.cap_thread = threading.Thread(target=self._capture_frames)
+        self.frame_ready = threading.Event()
+        # bounded-buffer credits for file sources, one atomic per frame
+        self._slots = threading.Semaphore(self.buffer_size)
+        self._items = threading.Semaphore(0)
+        # live sources overwrite the oldest frame, file sources block on back-pressure
+        capture_fn = self._capture_live if self.is_live else self._capture_file
+        self.cap_thread = threading.Thread(target=capture_fn)
 
         ret, frame = self.source.read()
         if not ret:
             raise RuntimeError('Unable to read video stream')
-        self.frame_queue.append(frame)
+        # appsink delivers 4-channel BGRx when the hardware converter is used
+        self.do_strip_alpha = frame.ndim == 3 and frame.shape[2] == 4
+        if self.do_strip_alpha:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
 
         width = self.source.get(cv2.CAP_PROP_FRAME_WIDTH)
         height = self.source.get(cv2.CAP_PROP_FRAME_HEIGHT)
         self.cap_fps = self.source.get(cv2.CAP_PROP_FPS)
-        self.do_resize = (width, height) != self.size
+        if WITH_GSTREAMER:
+            # the caps filter already scales frames to the output size
+            assert (width, height) == self.size, 'Capture caps do not match output size'
+            self.do_resize = False
+        else:
+            self.do_resize = (width, height) != self.size
+            # INTER_AREA is the vectorized fast path for downscaling
+            self.resize_interp = (cv2.INTER_AREA if width * height > self.size[0] * self.size[1]
+                                  else cv2.INTER_LINEAR)
+            if self.do_resize:
+                frame = cv2.resize(frame, self.size, interpolation=self.resize_interp)
+
         if self.cap_fps == 0:
             self.cap_fps = self.frame_rate # fallback to config if unknown
         LOGGER.info('%dx%d stream @ %d FPS', width, height, self.cap_fps)
 
+        # preallocate a ring of frame buffers so frames are decoded in place
+        # the spare slot keeps the producer from decoding into a published frame
+        self._ring = [_empty_frame((self.size[1], self.size[0], 3))
+                      for _ in range(self.buffer_size + 1)]
+        self._head = 0  # next slot to fill
+        self._tail = 0  # next slot to consume
+        np.copyto(self._ring[0], frame)
+        self._head = 1
+        if not self.is_live:
+            self._slots.acquire()
+            self._items.release()
+        # scratch buffer so BGRx frames also decode in place before the alpha strip
+        self._bgrx = (_empty_frame((self.size[1], self.size[0], 4))
+                      if self.do_strip_alpha else None)
+        # live reads swap the consumed slot out of the ring so the producer,
+        # which may lap and overwrite, can never touch it while it is processed
+        self._swap = (_empty_frame((self.size[1], self.size[0], 3))
+                      if self.is_live else None)
+
+        self.writer = None
         if self.output_uri is not None:
             Path(self.output_uri).parent.mkdir(parents=True, exist_ok=True)
             output_fps = 1 / self.cap_dt
             if WITH_GSTREAMER:
                 line = self._gst_write_pipeline()
-                print("Write pipeline: " + line)
+                LOGGER.debug('Write pipeline: %s', line)
                 self.writer = cv2.VideoWriter(line, cv2.CAP_GSTREAMER, 0,
                                               output_fps, self.size, True)
             else:
                 fourcc = cv2.VideoWriter_fourcc(*'avc1')
                 self.writer = cv2.VideoWriter(self.output_uri, fourcc, output_fps, self.size, True)
+            # encode off the main thread so write() never blocks on the encoder
+            self.write_queue = queue.Queue(maxsize=self.buffer_size)
+            self.write_thread = threading.Thread(target=self._write_frames)
+            self.write_thread.start()
 
     @property
     def cap_dt(self):
@@ -114,16 +214,18 @@ class VideoIO:
     def start_capture(self):
         """Start capturing from file or device."""
         if not self.source.isOpened():
-            self.source.open(self._gst_cap_pipeline(), cv2.CAP_GSTREAMER)
+            self.source.open(self.cap_pipeline, cv2.CAP_GSTREAMER)
         if not self.cap_thread.is_alive():
             self.cap_thread.start()
 
     def stop_capture(self):
         """Stop capturing from file or device."""
-        with self.cond:
-            self.exit_event.set()
-            self.cond.notify()
-        self.frame_queue.clear()
+        self.exit_event.set()
+        with self._lock:
+            self._tail = self._head  # discard buffered frames
+        self.frame_ready.set()   # wake the live consumer
+        self._slots.release()    # wake the file producer
+        self._items.release()    # wake the file consumer
         self.cap_thread.join()
 
     def read(self):
@@ -134,150 +236,246 @@ class VideoIO:
         ndarray
             Returns None if there are no more frames.
         """
-        with self.cond:
-            while len(self.frame_queue) == 0 and not self.exit_event.is_set():
-                self.cond.wait()
-            if len(self.frame_queue) == 0 and self.exit_event.is_set():
-                return None
-            frame = self.frame_queue.popleft()
-            self.cond.notify()
-        if self.do_resize:
-            frame = cv2.resize(frame, self.size)
+        if self.is_live:
+            while self._head == self._tail:
+                if self.exit_event.is_set():
+                    return None
+                self.frame_ready.wait()
+                self.frame_ready.clear()
+            with self._lock:
+                idx = self._tail % len(self._ring)
+                frame = self._ring[idx]
+                # trade the slot for the previously held buffer so the
+                # producer can lap the ring without clobbering this frame
+                self._ring[idx] = self._swap
+                self._swap = frame
+                self._tail += 1
+            return frame
+        self._items.acquire()
+        if self._head == self._tail:
+            self._items.release()  # keep further reads from blocking
+            return None
+        frame = self._ring[self._tail % len(self._ring)]
+        self._tail += 1
+        self._slots.release()
         return frame
 
     def write(self, frame):
         """Writes the next video frame."""
-        assert hasattr(self, 'writer')
-        self.writer.write(frame)
+        assert self.writer is not None
+        # snapshot the frame since ring slots are recycled by the capture thread
+        self.write_queue.put(frame.copy())
 
     def release(self):
         """Cleans up input and output sources."""
         self.stop_capture()
-        if hasattr(self, 'writer'):
+        if self.writer is not None:
+            self.write_queue.put(None)  # sentinel to stop the writer thread
+            self.write_thread.join()
             self.writer.release()
         self.source.release()
 
     def _gst_cap_pipeline(self):
-        gst_elements = str(subprocess.check_output('gst-inspect-1.0'))
-        if 'nvvidconv' in gst_elements and self.protocol != Protocol.V4L2:
+        return self._PIPELINES[self.protocol](self) + self._gst_cvt_pipeline()
+
+    def _gst_cvt_pipeline(self):
+        if self.is_live:
+            # bound sink memory to a single frame and drop stale ones at the sink
+            appsink = 'appsink sync=false emit-signals=false max-buffers=1 drop=true'
+        else:
+            appsink = 'appsink sync=false emit-signals=false max-buffers=%d' % self.buffer_size
+        if WITH_BGRX_APPSINK:
+            sink_pipeline = appsink
+        else:
+            # older cv2 builds only take BGR from appsink, repack on the CPU
+            sink_pipeline = 'videoconvert ! video/x-raw, format=BGR ! ' + appsink
+        if _gst_has_element('nvvidconv'):
             # format conversion for hardware decoder
             cvt_pipeline = (
                 'nvvidconv interpolation-method=5 ! '
-                'video/x-raw, width=%d, height=%d, format=BGRx !'
-                'videoconvert ! appsink sync=false'
-                % self.size
+                'video/x-raw, width=%d, height=%d, format=BGRx ! '
+                % self.size + sink_pipeline
             )
+            if self.protocol == Protocol.V4L2:
+                # upload YUY2 into NVMM so the conversion runs on the hardware scaler
+                cvt_pipeline = ('nvvidconv ! video/x-raw(memory:NVMM), format=NV12 ! '
+                                + cvt_pipeline)
+        elif _gst_has_element('nvvideoconvert'):
+            # dGPU hardware converter shipped with DeepStream
+            cvt_pipeline = (
+                'nvvideoconvert ! '
+                'video/x-raw, width=%d, height=%d, format=BGRx ! '
+                % self.size + sink_pipeline
+            )
+            if self.protocol == Protocol.V4L2:
+                cvt_pipeline = ('nvvideoconvert ! video/x-raw(memory:NVMM), format=NV12 ! '
+                                + cvt_pipeline)
         else:
             cvt_pipeline = (
                 'videoscale ! '
                 'video/x-raw, width=%d, height=%d !'
-                'videoconvert ! appsink sync=false'
-                % self.size
+                'videoconvert ! ' % self.size + appsink
             )
+        return cvt_pipeline
 
-        if self.protocol == Protocol.IMAGE:
-            pipeline = (
-                'multifilesrc location=%s index=1 caps="image/%s,framerate=%d/1" ! decodebin ! '
-                % (
-                    self.input_uri,
-                    self._img_format(self.input_uri),
-                    self.frame_rate
-                )
+    def _pipeline_image(self):
+        return (
+            'multifilesrc location=%s index=1 caps="image/%s,framerate=%d/1" ! decodebin ! '
+            % (
+                self.input_uri,
+                self._img_format(self.input_uri),
+                self.frame_rate
             )
-        elif self.protocol == Protocol.VIDEO:
-            pipeline = 'filesrc location=%s ! decodebin ! ' % self.input_uri
-        elif self.protocol == Protocol.CSI:
-            if 'nvarguscamerasrc' in gst_elements:
-                pipeline = (
-                    'nvarguscamerasrc sensor_id=%s ! '
-                    'video/x-raw(memory:NVMM), width=%d, height=%d, '
-                    'format=NV12, framerate=%d/1 ! '
-                    % (
-                        self.input_uri[6:],
-                        *self.resolution,
-                        self.frame_rate
-                    )
-                )
-            else:
-                raise RuntimeError('GStreamer CSI plugin not found')
-        elif self.protocol == Protocol.V4L2:
-            if 'v4l2src' in gst_elements:
-                #pipeline = (
-                #    'v4l2src device=%s ! '
-                #    'video/x-raw, width=%d, height=%d, '
-                #    'format=YUY2, framerate=%d/1 ! '
-                #    % (
-                #        self.input_uri,
-                #        *self.resolution,
-                #        self.frame_rate
-                #    )
-                #)
-                pipeline = (
-                    'v4l2src device=%s ! '
-                    'video/x-raw, width=%d, height=%d, '
-                    'format=YUY2 ! '
-                    % (
-                        self.input_uri,
-                        *self.resolution
-                    )
-                )
-            else:
-                raise RuntimeError('GStreamer V4L2 plugin not found')
-        elif self.protocol == Protocol.RTSP:
-            pipeline = (
-                'rtspsrc location=%s latency=0 ! '
-                'capsfilter caps=application/x-rtp,media=video ! decodebin ! ' % self.input_uri
+        )
+
+    def _pipeline_video(self):
+        if (_gst_has_element('nvv4l2decoder') and
+                self._probe_codec(self.input_uri) in _NVDEC_CODECS):
+            # parsebin autoplugs the demuxer/parser without a software decoder
+            return 'filesrc location=%s ! parsebin ! nvv4l2decoder ! ' % self.input_uri
+        return 'filesrc location=%s ! decodebin ! ' % self.input_uri
+
+    def _pipeline_csi(self):
+        if not _gst_has_element('nvarguscamerasrc'):
+            raise RuntimeError('GStreamer CSI plugin not found')
+        return (
+            'nvarguscamerasrc sensor_id=%s ! '
+            'video/x-raw(memory:NVMM), width=%d, height=%d, '
+            'format=NV12, framerate=%d/1 ! '
+            % (
+                self.input_uri[6:],
+                *self.resolution,
+                self.frame_rate
             )
-        elif self.protocol == Protocol.HTTP:
-            pipeline = 'souphttpsrc location=%s is-live=true ! decodebin ! ' % self.input_uri
-        return pipeline + cvt_pipeline
+        )
+
+    def _pipeline_v4l2(self):
+        if not _gst_has_element('v4l2src'):
+            raise RuntimeError('GStreamer V4L2 plugin not found')
+        return (
+            'v4l2src device=%s ! '
+            'video/x-raw, width=%d, height=%d, '
+            'format=YUY2 ! '
+            % (
+                self.input_uri,
+                *self.resolution
+            )
+        )
+
+    def _pipeline_rtsp(self):
+        if _gst_has_element('nvv4l2decoder'):
+            codec = self._probe_codec(self.input_uri)
+            # no parser/depayloader pair for the other hardware codecs over RTP
+            if codec in ('h264', 'h265'):
+                return (
+                    'rtspsrc location=%s latency=0 ! '
+                    'rtp%sdepay ! %sparse ! nvv4l2decoder ! '
+                    % (self.input_uri, codec, codec)
+                )
+        return (
+            'rtspsrc location=%s latency=0 ! '
+            'capsfilter caps=application/x-rtp,media=video ! decodebin ! ' % self.input_uri
+        )
+
+    def _pipeline_http(self):
+        if (_gst_has_element('nvv4l2decoder') and
+                self._probe_codec(self.input_uri) in _NVDEC_CODECS):
+            return ('souphttpsrc location=%s is-live=true ! '
+                    'parsebin ! nvv4l2decoder ! ' % self.input_uri)
+        return 'souphttpsrc location=%s is-live=true ! decodebin ! ' % self.input_uri
+
+    _PIPELINES = {
+        Protocol.IMAGE: _pipeline_image,
+        Protocol.VIDEO: _pipeline_video,
+        Protocol.CSI: _pipeline_csi,
+        Protocol.V4L2: _pipeline_v4l2,
+        Protocol.RTSP: _pipeline_rtsp,
+        Protocol.HTTP: _pipeline_http,
+    }
 
     def _gst_write_pipeline(self):
-        gst_elements = str(subprocess.check_output('gst-inspect-1.0'))
         # use hardware encoder if found
-        if 'omxh264enc' in gst_elements:
+        if _gst_has_element('nvv4l2h264enc'):
+            h264_encoder = 'nvv4l2h264enc'
+        elif _gst_has_element('omxh264enc'):
             h264_encoder = 'omxh264enc preset-level=2'
-        elif 'x264enc' in gst_elements:
-            h264_encoder = 'x264enc pass=4'
+        elif _gst_has_element('x264enc'):
+            h264_encoder = 'x264enc pass=4 speed-preset=superfast tune=zerolatency'
         else:
             raise RuntimeError('GStreamer H.264 encoder not found')
-#        pipeline = (
-#            'appsrc ! autovideoconvert ! %s ! qtmux ! filesink location=%s '
-#            % (
-#                h264_encoder,
-#                self.output_uri
-#            )
-#        )
-        pipeline = 'appsrc ! autovideoconvert ! xvimagesink'
+        # fixed appsrc caps avoid renegotiation on every buffer
+        pipeline = (
+            'appsrc is-live=true format=time do-timestamp=true ! '
+            'video/x-raw, format=BGR, width=%d, height=%d, framerate=%d/1 ! '
+            'videoconvert ! %s ! h264parse ! qtmux ! filesink location=%s'
+            % (*self.size, round(1 / self.cap_dt), h264_encoder, self.output_uri)
+        )
         return pipeline
 
-    def _capture_frames(self):
+    def _capture_live(self):
+        _pin_io_thread()
+        while not self.exit_event.is_set():
+            ret = self._decode_next()
+            if not ret:
+                self.exit_event.set()
+                self.frame_ready.set()
+                break
+            with self._lock:
+                # overwrite the oldest frame instead of blocking
+                if self._head - self._tail == self.buffer_size:
+                    self._tail += 1
+                self._head += 1
+            self.frame_ready.set()
+
+    def _capture_file(self):
+        _pin_io_thread()
         while not self.exit_event.is_set():
-            ret, frame = self.source.read()
-            with self.cond:
-                if not ret:
-                    self.exit_event.set()
-                    self.cond.notify()
-                    break
-                # keep unprocessed frames in the buffer for file
-                if not self.is_live:
-                    while (len(self.frame_queue) == self.buffer_size and
-                           not self.exit_event.is_set()):
-                        self.cond.wait()
-                self.frame_queue.append(frame)
-                self.cond.notify()
+            # wait for a free slot so unprocessed frames are kept
+            self._slots.acquire()
+            if self.exit_event.is_set():
+                break
+            if not self._decode_next():
+                self.exit_event.set()
+                self._items.release()  # wake the consumer
+                break
+            self._head += 1
+            self._items.release()
+
+    def _write_frames(self):
+        _pin_io_thread()
+        while True:
+            frame = self.write_queue.get()
+            if frame is None:
+                break
+            self.writer.write(frame)
+
+    def _decode_next(self):
+        """Decodes the next frame into the slot at the head of the ring.
+
+        Runs outside any lock so the consumer is never blocked on decoding.
+        """
+        slot = self._ring[self._head % len(self._ring)]
+        if self.do_strip_alpha:
+            # BGRx decodes into the scratch buffer, strip alpha into the slot
+            ret, frame = self.source.read(self._bgrx)
+            if ret:
+                cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR, dst=slot)
+            return ret
+        ret, frame = self.source.read(slot)
+        if ret and frame is not slot:
+            # source size differs from the slot, scale into it
+            if self.do_resize:
+                cv2.resize(frame, self.size, dst=slot, interpolation=self.resize_interp)
+            else:
+                np.copyto(slot, frame)
+        return ret
 
     @staticmethod
     def _parse_uri(uri):
         result = urlparse(uri)
-        if result.scheme == 'csi':
-            protocol = Protocol.CSI
-        elif result.scheme == 'rtsp':
-            protocol = Protocol.RTSP
-        elif result.scheme == 'http':
-            protocol = Protocol.HTTP
-        else:
-            if '/dev/video' in result.path:
+        protocol = _SCHEME_MAP.get(result.scheme)
+        if protocol is None:
+            if result.path.startswith('/dev/video'):
                 protocol = Protocol.V4L2
             elif '%' in result.path:
                 protocol = Protocol.IMAGE
@@ -285,6 +483,21 @@ class VideoIO:
                 protocol = Protocol.VIDEO
         return protocol
 
+    @staticmethod
+    def _probe_codec(uri):
+        # returns None if the codec cannot be determined
+        try:
+            discovery = subprocess.check_output(
+                ['gst-discoverer-1.0', uri],
+                stderr=subprocess.DEVNULL).decode('ascii', errors='ignore')
+        except (OSError, subprocess.SubprocessError):
+            return None
+        for name, codec in (('H.264', 'h264'), ('H.265', 'h265'),
+                            ('VP8', 'vp8'), ('VP9', 'vp9')):
+            if name in discovery:
+                return codec
+        return None
+
     @staticmethod
     def _img_format(uri):
         img_format = Path(uri).suffix[1:]